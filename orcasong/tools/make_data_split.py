@@ -10,8 +10,12 @@ import toml
 import argparse
 import h5py
 import random
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
+# number of threads that read input files at the same time
+DEFAULT_N_WORKERS = 16
+
 
 def get_parser():
     # TODO deprecated
@@ -68,6 +72,29 @@ def get_all_ip_group_keys(cfg):
     return ip_group_keys
 
 
+def get_chunk_cache_kwargs(cfg):
+    """
+    Gets the settings of the HDF5 chunk cache that is used when reading the input files.
+
+    Parameters
+    ----------
+    cfg : dict
+        Dict that contains all configuration options and additional information.
+
+    Returns
+    -------
+    chunk_cache_kwargs : dict
+        The rdcc_nbytes and rdcc_nslots keyword arguments for h5py.File.
+        They are None (= the HDF5 defaults) if not set in the cfg.
+
+    """
+    chunk_cache_kwargs = {
+        "rdcc_nbytes": cfg.get("rdcc_nbytes"),
+        "rdcc_nslots": cfg.get("rdcc_nslots"),
+    }
+    return chunk_cache_kwargs
+
+
 def get_h5_filepaths(dirpath):
     """
     Returns the filepaths of all .h5 files that are located in a specific directory.
@@ -83,10 +110,12 @@ def get_h5_filepaths(dirpath):
         List with the full filepaths of all .h5 files in the dirpath folder.
 
     """
-    filepaths = []
-    for f in os.listdir(dirpath):
-        if f.endswith(".h5"):
-            filepaths.append(dirpath + "/" + f)
+    with os.scandir(dirpath) as entries:
+        filepaths = [
+            os.path.join(dirpath, entry.name)
+            for entry in entries
+            if entry.name.endswith(".h5") and entry.is_file()
+        ]
 
     # randomize order
     random.Random(42).shuffle(filepaths)
@@ -94,7 +123,12 @@ def get_h5_filepaths(dirpath):
     return filepaths
 
 
-def get_number_of_evts(file, dataset_key="y"):
+def get_number_of_evts(
+    file,
+    dataset_key="y",
+    rdcc_nbytes=None,
+    rdcc_nslots=None,
+):
     """
     Returns the number of events of a file looking at the given dataset.
 
@@ -104,6 +138,10 @@ def get_number_of_evts(file, dataset_key="y"):
         File to read the number of events from.
     dataset_key : str
         String which specifies, which dataset in a h5 file should be used for calculating the number of events.
+    rdcc_nbytes : int, optional
+        Size of the HDF5 chunk cache in bytes. Default: HDF5 default.
+    rdcc_nslots : int, optional
+        Number of slots in the hash table of the HDF5 chunk cache. Default: HDF5 default.
 
     Returns
     -------
@@ -112,21 +150,86 @@ def get_number_of_evts(file, dataset_key="y"):
 
     """
 
-    f = h5py.File(file, "r")
-    dset = f[dataset_key]
-    n_evts = dset.shape[0]
-    f.close()
+    with h5py.File(
+        file, "r", rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots
+    ) as f:
+        # read the shape directly from the low-level dataset id
+        n_evts = int(f[dataset_key].id.shape[0])
 
     return n_evts
 
 
+def get_number_of_evts_of_files(
+    list_of_files, n_evts_cache=None, n_workers=DEFAULT_N_WORKERS, **kwargs
+):
+    """
+    Returns the number of events of each file in the list_of_files.
+
+    Files that are not in the n_evts_cache are read in parallel with a pool of threads.
+
+    Parameters
+    ----------
+    list_of_files : list
+        List which contains filepaths to h5 files.
+    n_evts_cache : dict, optional
+        Already known number of events, with the filepaths as keys.
+    n_workers : int
+        Maximum number of threads that read files at the same time.
+    kwargs
+        Passed on to get_number_of_evts.
+
+    Returns
+    -------
+    n_evts_list : list
+        The number of events of each file, in the order of list_of_files.
+
+    """
+    if n_evts_cache is None:
+        n_evts_cache = {}
+
+    to_read = [fpath for fpath in list_of_files if fpath not in n_evts_cache]
+    read = {}
+    if to_read:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            n_evts_read = list(executor.map(
+                lambda fpath: get_number_of_evts(fpath, **kwargs), to_read
+            ))
+        read = dict(zip(to_read, n_evts_read))
+
+    return [
+        read[fpath] if fpath in read else n_evts_cache[fpath]
+        for fpath in list_of_files
+    ]
+
+
+def _get_number_of_evts_and_run_id(
+    fpath, dataset_key, run_id_col_name, rdcc_nbytes, rdcc_nslots
+):
+    """ Get the number of events and the run_id of a single h5 file. """
+    with h5py.File(
+        fpath, "r", rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots
+    ) as f:
+        dset = f[dataset_key]
+        n_evts = int(dset.id.shape[0])
+        # only read the run_id field of the first row, not the whole row
+        run_id = dset.fields(run_id_col_name)[0]
+
+    return n_evts, run_id
+
+
 def get_number_of_evts_and_run_ids(
-    list_of_files, dataset_key="y", run_id_col_name="run_id"
+    list_of_files,
+    dataset_key="y",
+    run_id_col_name="run_id",
+    n_workers=DEFAULT_N_WORKERS,
+    rdcc_nbytes=None,
+    rdcc_nslots=None,
 ):
     """
     Gets the number of events and the run_ids for all hdf5 files in the list_of_files.
 
     The number of events is calculated based on the dataset, which is specified with the dataset_key parameter.
+    The files are read in parallel with a pool of threads.
 
     Parameters
     ----------
@@ -136,6 +239,12 @@ def get_number_of_evts_and_run_ids(
         String which specifies, which dataset in a h5 file should be used for calculating the number of events.
     run_id_col_name : str
         String, which specifies the column name of the 'run_id' column.
+    n_workers : int
+        Maximum number of threads that read files at the same time.
+    rdcc_nbytes : int, optional
+        Size of the HDF5 chunk cache in bytes. Default: HDF5 default.
+    rdcc_nslots : int, optional
+        Number of slots in the hash table of the HDF5 chunk cache. Default: HDF5 default.
 
     Returns
     -------
@@ -145,27 +254,30 @@ def get_number_of_evts_and_run_ids(
         The mean number of evts per file.
     run_ids : list
         List containing the run_ids of the files in the list_of_files.
+    n_evts_per_file : dict
+        The number of events of each file, with the filepaths as keys.
 
     """
 
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(
+            lambda fpath: _get_number_of_evts_and_run_id(
+                fpath, dataset_key, run_id_col_name, rdcc_nbytes, rdcc_nslots),
+            list_of_files,
+        ))
+
     total_number_of_evts = 0
     run_ids = []
+    n_evts_per_file = {}
 
-    for i, fpath in enumerate(list_of_files):
-        f = h5py.File(fpath, "r")
-
-        dset = f[dataset_key]
-        n_evts = dset.shape[0]
+    for fpath, (n_evts, run_id) in zip(list_of_files, results):
         total_number_of_evts += n_evts
-
-        run_id = f[dataset_key][0][run_id_col_name]
+        n_evts_per_file[fpath] = n_evts
         run_ids.append(run_id)
 
-        f.close()
-
     mean_number_of_evts_per_file = total_number_of_evts / len(list_of_files)
 
-    return total_number_of_evts, mean_number_of_evts_per_file, run_ids
+    return total_number_of_evts, mean_number_of_evts_per_file, run_ids, n_evts_per_file
 
 
 def split(a, n):
@@ -185,11 +297,8 @@ def split(a, n):
         The input list a, which has been split into n chunks.
 
     """
-    # from https://stackoverflow.com/questions/2130016/splitting-a-list-into-n-parts-of-approximately-equal-length
-    k, m = divmod(len(a), n)
-    a_split = list(
-        (a[i * k + min(i, m) : (i + 1) * k + min(i + 1, m)] for i in range(n))
-    )
+    # object dtype, so that the elements stay the original python objects
+    a_split = [list(chunk) for chunk in np.array_split(np.asarray(a, dtype=object), n)]
     return a_split
 
 
@@ -243,19 +352,20 @@ def add_fpaths_for_data_split_to_cfg(cfg, key):
 
     """
 
-    fpath_lists = {"train": [], "validate": [], "rest": []}
-    for i, fpath in enumerate(cfg[key]["fpaths"]):
+    # run_id ranges of the dsplits that are used for this input group
+    run_id_ranges = [
+        (dsplit, cfg[key]["run_ids_" + dsplit][0], cfg[key]["run_ids_" + dsplit][1])
+        for dsplit in ["train", "validate", "rest"]
+        if "run_ids_" + dsplit in cfg[key]
+    ]
 
-        run_id = cfg[key]["run_ids"][i]
+    run_ids = np.asarray(cfg[key]["run_ids"])
+    fpaths = np.asarray(cfg[key]["fpaths"], dtype=object)
 
-        for dsplit in ["train", "validate", "rest"]:
-            if "run_ids_" + dsplit in cfg[key]:
-                if (
-                    cfg[key]["run_ids_" + dsplit][0]
-                    <= run_id
-                    <= cfg[key]["run_ids_" + dsplit][1]
-                ):
-                    fpath_lists[dsplit].append(fpath)
+    fpath_lists = {"train": [], "validate": [], "rest": []}
+    for dsplit, run_id_min, run_id_max in run_id_ranges:
+        in_range = (run_ids >= run_id_min) & (run_ids <= run_id_max)
+        fpath_lists[dsplit] = fpaths[in_range].tolist()
 
     for dsplit in ["train", "validate", "rest"]:
         if len(fpath_lists[dsplit]) == 0:
@@ -278,9 +388,13 @@ def make_dsplit_list_files(cfg):
         Dict that contains all configuration options and additional information.
 
     """
+    list_files_folder = os.path.join(cfg["output_file_folder"], "conc_list_files")
+    # prefix of all output list files
+    list_files_base = os.path.join(list_files_folder, cfg["output_file_name"])
+
     # check if //conc_list_files folder exists, if not create it.
-    if not os.path.exists(cfg["output_file_folder"] + "/conc_list_files"):
-        os.makedirs(cfg["output_file_folder"] + "/conc_list_files")
+    if not os.path.exists(list_files_folder):
+        os.makedirs(list_files_folder)
 
     print()
     print()
@@ -301,34 +415,45 @@ def make_dsplit_list_files(cfg):
 
         # initialize counter of events for all input groups
         imput_groups_dict = cfg["output_" + dsplit]
+        keys = list(imput_groups_dict.keys())
         final_number_of_events = np.zeros(len(imput_groups_dict))
 
+        # reuse the number of events cached during the input scan
+        n_evts_cache = {}
+        for key in keys:
+            n_evts_cache.update(cfg[key].get("n_evts_per_file", {}))
+
         # loop over the number of outputfiles for each set
         for i in range(n_output_files):
-            fpath_output = (
-                cfg["output_file_folder"]
-                + "/conc_list_files/"
-                + cfg["output_file_name"]
-                + "_"
-                + dsplit
-                + "_"
-                + str(i)
-                + ".txt"
-            )
+            fpath_output = f"{list_files_base}_{dsplit}_{i}.txt"
 
             # save the txt list
             if "output_lists" not in cfg:
                 cfg["output_lists"] = list()
             cfg["output_lists"].append(fpath_output)
 
-            with open(fpath_output, "w") as f_out:
-                for j in range(len(imput_groups_dict)):
-                    keys = list(imput_groups_dict.keys())
+            lines = []
+            # lines[group_offsets[j]:group_offsets[j+1]] are the files of input group j
+            group_offsets = [0]
+            for j in range(len(imput_groups_dict)):
+                lines.extend(imput_groups_dict[keys[j]][i])
+                group_offsets.append(len(lines))
+
+            # also count here the actual sizes
+            n_evts_lines = get_number_of_evts_of_files(
+                lines,
+                n_evts_cache=n_evts_cache,
+                n_workers=cfg.get("n_workers", DEFAULT_N_WORKERS),
+                **get_chunk_cache_kwargs(cfg),
+            )
+            for j in range(len(imput_groups_dict)):
+                final_number_of_events[j] += sum(
+                    n_evts_lines[group_offsets[j] : group_offsets[j + 1]]
+                )
 
-                    for fpath in imput_groups_dict[keys[j]][i]:
-                        # also count here the actual sizes
-                        final_number_of_events[j] += get_number_of_evts(fpath)
-                        f_out.write(fpath + "\n")
+            # write the whole list at once
+            with open(fpath_output, "w") as f_out:
+                f_out.write("".join(fpath + "\n" for fpath in lines))
 
         # and then print them
         for i in range(len(imput_groups_dict)):
@@ -461,7 +586,13 @@ def make_split(config_file):
             cfg[key]["n_evts"],
             cfg[key]["n_evts_per_file_mean"],
             cfg[key]["run_ids"],
-        ) = get_number_of_evts_and_run_ids(cfg[key]["fpaths"], dataset_key="y")
+            cfg[key]["n_evts_per_file"],
+        ) = get_number_of_evts_and_run_ids(
+            cfg[key]["fpaths"],
+            dataset_key="y",
+            n_workers=cfg.get("n_workers", DEFAULT_N_WORKERS),
+            **get_chunk_cache_kwargs(cfg),
+        )
 
         n_evts_total += cfg[key]["n_evts"]
 
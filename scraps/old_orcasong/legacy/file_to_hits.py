@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 """Code that reads the h5 simulation files and extracts the necessary information for making event images."""
 
+import functools
 import numpy as np
 import km3pipe as kp
+from numba import njit
 
 
 def get_primary_track_index(event_blob):
@@ -23,11 +25,29 @@ def get_primary_track_index(event_blob):
         Index of the primary track (=neutrino) in the 'McTracks' branch.
 
     """
-    bjorken_y_array = event_blob['McTracks'].bjorkeny
-    primary_index = np.where(bjorken_y_array != 0.0)[0][0]
+    is_primary = event_blob['McTracks'].bjorkeny != 0.0
+    if not is_primary.any():
+        raise ValueError('No McTrack with bjorkeny != 0 found, the primary track could not be determined.')
+
+    primary_index = int(np.argmax(is_primary))
     return primary_index
 
 
+@njit(cache=True)
+def _mean_time_triggered_hits(hits_time, triggered):
+    """ Mean time of all hits with triggered == 1, in a single pass without temporary arrays. """
+    t_sum = 0.0
+    n_triggered = 0
+    for i in range(hits_time.shape[0]):
+        if triggered[i] == 1:
+            t_sum += hits_time[i]
+            n_triggered += 1
+    if n_triggered == 0:
+        # like np.mean of an empty array, instead of raising a ZeroDivisionError
+        return np.nan
+    return t_sum / n_triggered
+
+
 def get_time_residual_nu_interaction_mean_triggered_hits(time_interaction, hits_time, triggered):
     """
     Gets the time_residual of the event with respect to mean time of the triggered hits.
@@ -48,13 +68,48 @@ def get_time_residual_nu_interaction_mean_triggered_hits(time_interaction, hits_
         Array with trigger flags that specifies if the hit is triggered or not.
 
     """
-    hits_time_triggered = hits_time[triggered == 1]
-    t_mean_triggered = np.mean(hits_time_triggered, dtype=np.float64)
+    t_mean_triggered = _mean_time_triggered_hits(hits_time, triggered)
     time_residual_vertex = t_mean_triggered - time_interaction
 
     return time_residual_vertex
 
 
+@njit(cache=True)
+def _assemble_hits(pos_x, pos_y, pos_z, hits_time, triggered, channel_id, use_channel_id, apply_triggered_cut):
+    """
+    Fills the event_hits array [pos_x, pos_y, pos_z, time, triggered, (channel_id)] from the hit columns.
+
+    If apply_triggered_cut is True, only the hits with triggered != 0 are taken.
+
+    """
+    n_hits = pos_x.shape[0]
+    if apply_triggered_cut:
+        n_out = 0
+        for i in range(n_hits):
+            if triggered[i] != 0:
+                n_out += 1
+    else:
+        n_out = n_hits
+
+    n_cols = 6 if use_channel_id else 5
+    event_hits = np.empty((n_out, n_cols), dtype=np.float64)
+
+    j = 0
+    for i in range(n_hits):
+        if apply_triggered_cut and triggered[i] == 0:
+            continue
+        event_hits[j, 0] = pos_x[i]
+        event_hits[j, 1] = pos_y[i]
+        event_hits[j, 2] = pos_z[i]
+        event_hits[j, 3] = hits_time[i]
+        event_hits[j, 4] = triggered[i]
+        if use_channel_id:
+            event_hits[j, 5] = channel_id[i]
+        j += 1
+
+    return event_hits
+
+
 def get_hits(event_blob, geo, do_mc_hits, data_cuts, do4d):
     """
     Returns a hits array that contains [pos_x, pos_y, pos_z, time, triggered, channel_id (optional)].
@@ -80,28 +135,203 @@ def get_hits(event_blob, geo, do_mc_hits, data_cuts, do4d):
     -------
     event_hits : ndarray(ndim=2)
         2D array that contains the hits data for the input event [pos_x, pos_y, pos_z, time, triggered, (channel_id)].
+    hits_time : ndarray(ndim=1)
+        Time of the hits in event_hits, i.e. with the triggered cut applied if it is set in the data_cuts.
+    triggered : ndarray(ndim=1)
+        Trigger flags of the hits in event_hits, i.e. with the triggered cut applied if it is set in the data_cuts.
+        Together with hits_time, this can be used in get_tracks without going through event_hits again.
 
     """
     # parse hits [x,y,z,time]
     hits = event_blob['Hits'] if do_mc_hits is False else event_blob['McHits']
 
+    apply_triggered_cut = data_cuts['triggered'] is True
+
     if 'pos_x' not in event_blob['Hits'].dtype.names: # check if blob already calibrated
+        if apply_triggered_cut:
+            # only calibrate the hits that survive the triggered cut
+            hits = hits[hits.triggered.astype(np.bool_, copy=False)]
+            apply_triggered_cut = False
         hits = geo.apply(hits)
 
-    if data_cuts['triggered'] is True:
-        hits = hits.triggered_hits # alternative, though it only works for the triggered condition!
+    use_channel_id = (do4d[0] is True and do4d[1] == 'channel_id') or do4d[1] == 'xzt-c'
+    channel_id = hits.channel_id if use_channel_id else np.empty(0, dtype=np.float64)
 
-    pos_x, pos_y, pos_z = hits.pos_x, hits.pos_y, hits.pos_z
-    hits_time = hits.time
-    triggered = hits.triggered
+    hits_time, triggered = hits.time, hits.triggered
+    # for calibrated hits, the triggered cut is applied column by column in here,
+    # so the full hits table is never copied
+    event_hits = _assemble_hits(hits.pos_x, hits.pos_y, hits.pos_z, hits_time, triggered, channel_id,
+                                use_channel_id, apply_triggered_cut)
 
-    ax = np.newaxis
-    event_hits = np.concatenate([pos_x[:, ax], pos_y[:, ax], pos_z[:, ax], hits_time[:, ax], triggered[:, ax]], axis=1) # dtype: np.float64
+    if apply_triggered_cut:
+        # return the same hits as in event_hits
+        is_triggered = triggered != 0
+        hits_time, triggered = hits_time[is_triggered], triggered[is_triggered]
 
-    if do4d[0] is True and do4d[1] == 'channel_id' or do4d[1] == 'xzt-c':
-        event_hits = np.concatenate([event_hits, hits.channel_id[:, ax]], axis=1)
+    return event_hits, hits_time, triggered
 
-    return event_hits
+
+def get_run_id(event_blob, file_particle_type):
+    """
+    Returns the run_id of the input event.
+
+    Parameters
+    ----------
+    event_blob : kp.io.HDF5Pump.blob
+        Event blob of the HDF5Pump which contains all information for one event.
+    file_particle_type : str
+        String that specifies the type of particles that are contained in the file: ['undefined', 'muon', 'neutrino'].
+
+    Returns
+    -------
+    run_id : float
+        The run_id of the event, taken from the Header if it exists.
+
+    """
+    if 'Header' in event_blob: # if Header exists in file, take run_id from it.
+        run_id = event_blob['Header'].start_run.run_id.astype('float32')
+    else:
+        if file_particle_type == 'undefined': # currently used with random_noise files
+            run_id = event_blob['EventInfo'].run_id
+        else:
+            raise ValueError('The run_id could not be read from the EventInfo or the Header, '
+                             'please check the source code in get_run_id().')
+    return run_id
+
+
+# columns of the event_track, dependent on the file_particle_type
+_TRACK_COLUMNS = {
+    'undefined': ('event_id', 'run_id', 'particle_type', 'frame_index'),
+    'muon': ('event_id', 'particle_type', 'energy', 'is_cc', 'bjorkeny', 'dir_x', 'dir_y', 'dir_z',
+             'time_interaction', 'run_id', 'vertex_pos_x', 'vertex_pos_y', 'vertex_pos_z', 'n_muons'),
+    'neutrino': ('event_id', 'particle_type', 'energy', 'is_cc', 'bjorkeny', 'dir_x', 'dir_y', 'dir_z',
+                 'time_interaction', 'run_id', 'vertex_pos_x', 'vertex_pos_y', 'vertex_pos_z',
+                 'time_residual_vertex'),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_track_dtype(file_particle_type, has_prod_ident):
+    """ The dtype of the event_track, only built once per file_particle_type. """
+    columns = _TRACK_COLUMNS[file_particle_type]
+    if has_prod_ident:
+        columns = columns + ('prod_ident', )
+    return np.dtype([(column, np.float64) for column in columns])
+
+
+def _new_event_track(file_particle_type, prod_ident):
+    """ Returns an empty, single row event_track array that can be filled column by column. """
+    # not reused between events, since the km3pipe Table of each event may keep a reference to it
+    event_track = np.empty(1, dtype=_get_track_dtype(file_particle_type, prod_ident is not None))
+    if prod_ident is not None:
+        event_track['prod_ident'] = prod_ident
+    return event_track
+
+
+def _to_table(event_track):
+    """ Wraps the filled event_track array into a km3pipe Table. """
+    return kp.dataclasses.Table(event_track, h5loc='y', name='Event_Information')
+
+
+def _get_tracks_undefined(event_blob, hits_time, triggered, prod_ident, run_id):
+    """ get_tracks for file_particle_type = 'undefined'. """
+    # km3pipe event_id is the aanet frame_index
+    # for random_noise files, multiple events have the same frame_index, so use the group_id instead
+    event_track = _new_event_track('undefined', prod_ident)
+    event_track['event_id'] = event_blob['EventInfo'].group_id[0]
+    event_track['run_id'] = run_id
+    event_track['particle_type'] = 0
+    event_track['frame_index'] = event_blob['EventInfo'].event_id[0]
+
+    return _to_table(event_track)
+
+
+def _get_tracks_muon(event_blob, hits_time, triggered, prod_ident, run_id):
+    """ get_tracks for file_particle_type = 'muon'. """
+    event_track = _new_event_track('muon', prod_ident)
+    event_track['event_id'] = event_blob['EventInfo'].event_id[0]
+    event_track['run_id'] = run_id
+
+    mc_tracks = event_blob['McTracks']
+    # take index 1, index 0 is the empty neutrino mc_track
+    muon = mc_tracks[1]
+    event_track['particle_type'] = muon.type # assumed that this is the same for all muons in a bundle
+    event_track['is_cc'] = muon.is_cc # always 1 actually
+    event_track['bjorkeny'] = muon.bjorkeny # always 0 actually
+    event_track['time_interaction'] = muon.time  # same for all muons in a bundle
+    event_track['n_muons'] = mc_tracks.shape[0] - 1 # takes position of time_residual_vertex in 'neutrino' case
+
+    # sum up the energy of all muons
+    event_track['energy'] = np.sum(mc_tracks.energy)
+
+    # all muons in a bundle are parallel, so just take dir of first muon
+    event_track['dir_x'], event_track['dir_y'], event_track['dir_z'] = muon.dir_x, muon.dir_y, muon.dir_z
+
+    # vertex is the weighted (energy) mean of the individual vertices
+    muon_energies = mc_tracks.energy[1:]
+    inv_energy_sum = 1.0 / np.sum(muon_energies)
+    event_track['vertex_pos_x'] = np.dot(mc_tracks.pos_x[1:], muon_energies) * inv_energy_sum
+    event_track['vertex_pos_y'] = np.dot(mc_tracks.pos_y[1:], muon_energies) * inv_energy_sum
+    event_track['vertex_pos_z'] = np.dot(mc_tracks.pos_z[1:], muon_energies) * inv_energy_sum
+
+    return _to_table(event_track)
+
+
+def _get_tracks_neutrino(event_blob, hits_time, triggered, prod_ident, run_id):
+    """ get_tracks for file_particle_type = 'neutrino'. """
+    event_track = _new_event_track('neutrino', prod_ident)
+    event_track['event_id'] = event_blob['EventInfo'].event_id[0]
+    event_track['run_id'] = run_id
+
+    p = get_primary_track_index(event_blob)
+    primary = event_blob['McTracks'][p]
+    event_track['particle_type'] = primary.type
+    event_track['energy'] = primary.energy
+    event_track['is_cc'] = primary.is_cc
+    event_track['bjorkeny'] = primary.bjorkeny
+    event_track['dir_x'], event_track['dir_y'], event_track['dir_z'] = primary.dir_x, primary.dir_y, primary.dir_z
+    time_interaction = primary.time  # actually always 0 for primary neutrino, measured in MC time
+    event_track['time_interaction'] = time_interaction
+    event_track['vertex_pos_x'], event_track['vertex_pos_y'], event_track['vertex_pos_z'] = \
+        primary.pos_x, primary.pos_y, primary.pos_z
+
+    event_track['time_residual_vertex'] = get_time_residual_nu_interaction_mean_triggered_hits(
+        time_interaction, hits_time, triggered)
+
+    return _to_table(event_track)
+
+
+_GET_TRACKS_FUNCTIONS = {
+    'undefined': _get_tracks_undefined,
+    'muon': _get_tracks_muon,
+    'neutrino': _get_tracks_neutrino,
+}
+
+
+def get_tracks_function(file_particle_type):
+    """
+    Returns the get_tracks function that is specialized for the particles contained in the file.
+
+    Since the file_particle_type is the same for all events of a file, this can be done once per file
+    instead of once per event.
+
+    Parameters
+    ----------
+    file_particle_type : str
+        String that specifies the type of particles that are contained in the file: ['undefined', 'muon', 'neutrino'].
+
+    Returns
+    -------
+    get_tracks_fn : function
+        Function with the signature get_tracks_fn(event_blob, hits_time, triggered, prod_ident, run_id),
+        which returns the event_track like get_tracks. hits_time and triggered are the columns returned
+        by get_hits, the run_id can be obtained with get_run_id.
+
+    """
+    try:
+        return _GET_TRACKS_FUNCTIONS[file_particle_type]
+    except KeyError:
+        raise ValueError('The file_particle_type "' + str(file_particle_type) + '" is not known.')
 
 
 def get_tracks(event_blob, file_particle_type, event_hits, prod_ident):
@@ -132,85 +362,10 @@ def get_tracks(event_blob, file_particle_type, event_hits, prod_ident):
         vertex_pos_x, vertex_pos_y, vertex_pos_z, time_residual_vertex/n_muons, (prod_ident)].
 
     """
-    ## parse EventInfo and Header information
-
-    # km3pipe event_id is the aanet frame_index
-    # for random_noise files, multiple events have the same frame_index, so use the group_id instead
-    if file_particle_type == 'undefined':
-        event_id = event_blob['EventInfo'].group_id[0]
-    else:
-        event_id = event_blob['EventInfo'].event_id[0]
-
-    if 'Header' in event_blob: # if Header exists in file, take run_id from it.
-        run_id = event_blob['Header'].start_run.run_id.astype('float32')
-    else:
-        if file_particle_type == 'undefined': # currently used with random_noise files
-            run_id = event_blob['EventInfo'].run_id
-        else:
-            raise ValueError('The run_id could not be read from the EventInfo or the Header, '
-                             'please check the source code in get_tracks().')
-
-    ## collect all event_track information, dependent on file_particle_type
-
-    if file_particle_type == 'undefined':
-        particle_type = 0
-        frame_index = event_blob['EventInfo'].event_id[0]
-
-        track = {'event_id': event_id, 'run_id': run_id, 'particle_type': particle_type, 'frame_index': frame_index}
-
-    elif file_particle_type == 'muon':
-        # take index 1, index 0 is the empty neutrino mc_track
-        particle_type = event_blob['McTracks'][1].type # assumed that this is the same for all muons in a bundle
-        is_cc = event_blob['McTracks'][1].is_cc # always 1 actually
-        bjorkeny = event_blob['McTracks'][1].bjorkeny # always 0 actually
-        time_interaction = event_blob['McTracks'][1].time  # same for all muons in a bundle
-        n_muons = event_blob['McTracks'].shape[0] - 1 # takes position of time_residual_vertex in 'neutrino' case
-
-        # sum up the energy of all muons
-        energy = np.sum(event_blob['McTracks'].energy)
-
-        # all muons in a bundle are parallel, so just take dir of first muon
-        dir_x, dir_y, dir_z = event_blob['McTracks'][1].dir_x, event_blob['McTracks'][1].dir_y, event_blob['McTracks'][1].dir_z
-
-        # vertex is the weighted (energy) mean of the individual vertices
-        vertex_pos_x = np.average(event_blob['McTracks'][1:].pos_x, weights=event_blob['McTracks'][1:].energy)
-        vertex_pos_y = np.average(event_blob['McTracks'][1:].pos_y, weights=event_blob['McTracks'][1:].energy)
-        vertex_pos_z = np.average(event_blob['McTracks'][1:].pos_z, weights=event_blob['McTracks'][1:].energy)
-
-        track = {'event_id': event_id, 'particle_type': particle_type, 'energy': energy, 'is_cc': is_cc,
-                 'bjorkeny': bjorkeny, 'dir_x': dir_x, 'dir_y': dir_y, 'dir_z': dir_z,
-                 'time_interaction': time_interaction,  'run_id': run_id, 'vertex_pos_x': vertex_pos_x,
-                 'vertex_pos_y': vertex_pos_y, 'vertex_pos_z': vertex_pos_z, 'n_muons': n_muons}
-
-    elif file_particle_type == 'neutrino':
-        p = get_primary_track_index(event_blob)
-        particle_type = event_blob['McTracks'][p].type
-        energy = event_blob['McTracks'][p].energy
-        is_cc = event_blob['McTracks'][p].is_cc
-        bjorkeny = event_blob['McTracks'][p].bjorkeny
-        dir_x, dir_y, dir_z = event_blob['McTracks'][p].dir_x, event_blob['McTracks'][p].dir_y, event_blob['McTracks'][p].dir_z
-        time_interaction = event_blob['McTracks'][p].time  # actually always 0 for primary neutrino, measured in MC time
-        vertex_pos_x, vertex_pos_y, vertex_pos_z = event_blob['McTracks'][p].pos_x, event_blob['McTracks'][p].pos_y, \
-                                                   event_blob['McTracks'][p].pos_z
-
-        hits_time, triggered = event_hits[:, 3], event_hits[:, 4]
-        time_residual_vertex = get_time_residual_nu_interaction_mean_triggered_hits(time_interaction, hits_time, triggered)
-
-        track = {'event_id': event_id, 'particle_type': particle_type, 'energy': energy, 'is_cc': is_cc,
-                 'bjorkeny': bjorkeny, 'dir_x': dir_x, 'dir_y': dir_y, 'dir_z': dir_z,
-                 'time_interaction': time_interaction,  'run_id': run_id, 'vertex_pos_x': vertex_pos_x,
-                 'vertex_pos_y': vertex_pos_y, 'vertex_pos_z': vertex_pos_z,
-                 'time_residual_vertex': time_residual_vertex}
-
-    else:
-        raise ValueError('The file_particle_type "', str(file_particle_type), '" is not known.')
-
-    if prod_ident is not None: track['prod_ident'] = prod_ident
-
-    dtypes = [(key, np.float64) for key in track.keys()]
-    event_track = kp.dataclasses.Table(track, dtype=dtypes, h5loc='y', name='Event_Information')
-
-    return event_track
+    get_tracks_fn = get_tracks_function(file_particle_type)
+    run_id = get_run_id(event_blob, file_particle_type)
+    hits_time, triggered = event_hits[:, 3], event_hits[:, 4]
+    return get_tracks_fn(event_blob, hits_time, triggered, prod_ident, run_id)
 
 
 class EventDataExtractor(kp.Module):
@@ -230,6 +385,10 @@ class EventDataExtractor(kp.Module):
         self.prod_ident = self.require('prod_ident')
         self.event_hits_key = self.get('event_hits', default='event_hits')
         self.event_track_key = self.get('event_track', default='event_track')
+        # the particle type is the same for the whole file, so choose the get_tracks function only once
+        self.get_tracks = get_tracks_function(self.file_particle_type)
+        # same for the run_id, it is read from the first event
+        self.run_id = None
 
     def process(self, blob):
         """
@@ -246,8 +405,11 @@ class EventDataExtractor(kp.Module):
             Dictionary that contains the event_hits array and the event_track array.
 
         """
-        blob[self.event_hits_key] = get_hits(blob, self.geo, self.do_mc_hits, self.data_cuts, self.do4d)
-        blob[self.event_track_key] = get_tracks(blob, self.file_particle_type, blob[self.event_hits_key], self.prod_ident)
+        event_hits, hits_time, triggered = get_hits(blob, self.geo, self.do_mc_hits, self.data_cuts, self.do4d)
+        blob[self.event_hits_key] = event_hits
+        if self.run_id is None:
+            self.run_id = get_run_id(blob, self.file_particle_type)
+        blob[self.event_track_key] = self.get_tracks(blob, hits_time, triggered, self.prod_ident, self.run_id)
         return blob
 
 
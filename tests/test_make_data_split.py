@@ -80,7 +80,21 @@ class TestMakeDataSplit(TestCase):
 		for key in self.ip_group_keys:
 			self.assertIn(self.cfg[key]['fpaths'][0],self.file_path_list)
 			self.assertIn(self.cfg[key]['n_evts'],self.n_events_list)
+			self.assertEqual(sum(self.cfg[key]['n_evts_per_file'].values()),self.cfg[key]['n_evts'])
 	
+	def test_get_number_of_evts_of_files(self):
+		files = [mupage_file, neutrino_file]
+		n_evts_list = mds.get_number_of_evts_of_files(files, n_workers=2)
+		self.assertSequenceEqual(n_evts_list,[mds.get_number_of_evts(fpath) for fpath in files])
+		#cached files are not read again
+		n_evts_list = mds.get_number_of_evts_of_files(files, n_evts_cache={mupage_file: 42})
+		self.assertEqual(n_evts_list[0],42)
+		self.assertEqual(n_evts_list[1],mds.get_number_of_evts(neutrino_file))
+		
+	def test_split(self):
+		a_split = mds.split(['a','b','c','d','e'], 3)
+		self.assertSequenceEqual(a_split,[['a','b'],['c','d'],['e']])
+		
 	def test_make_split(self):
 		#main
 		#repeat first 3 steps
@@ -152,7 +166,7 @@ def update_cfg(cfg):
 		print('Collecting information from input group ' + key)
 		cfg[key]['fpaths'] = mds.get_h5_filepaths(cfg[key]['dir'])
 		cfg[key]['n_files'] = len(cfg[key]['fpaths'])
-		cfg[key]['n_evts'], cfg[key]['n_evts_per_file_mean'], cfg[key]['run_ids'] = mds.get_number_of_evts_and_run_ids(cfg[key]['fpaths'], dataset_key='y')
+		cfg[key]['n_evts'], cfg[key]['n_evts_per_file_mean'], cfg[key]['run_ids'], cfg[key]['n_evts_per_file'] = mds.get_number_of_evts_and_run_ids(cfg[key]['fpaths'], dataset_key='y')
 		n_evts_total += cfg[key]['n_evts']
 			
 	return cfg,n_evts_total